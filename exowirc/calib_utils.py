@@ -1,19 +1,32 @@
 import numpy as np
+import os
+import time
+import queue
+import threading
+import itertools
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from scipy.ndimage import median_filter
 from astropy.io import fits
 from astropy import time as ap_time, coordinates as coord, units as u
-from astropy.stats import median_absolute_deviation, sigma_clip, \
-	sigma_clipped_stats
+from astropy.stats import median_absolute_deviation, sigma_clip
 import cv2
 
 from .io_utils import get_science_img_list, load_calib_files, \
-	get_img_name, save_image, save_multicomponent_frame, save_covariates
+	get_img_name, save_image, save_multicomponent_frame, save_covariates, \
+	get_mcf_name, get_mcf_dump_name, save_npy, load_master_frame, \
+	load_manifest, save_manifest, get_product_digest, check_product, \
+	record_product, get_file_checksum, append_journal, load_journal, \
+	check_journal_entry
 
 def calibrate_all(raw_dir, calib_dir, dump_dir, science_ranges, dark_ranges,
 	dark_for_flat_range, flat_range, destripe = True, style = 'wirc',
 	background_mode = None, bkg_filename = None,
 	correct_nonlinearity = False, remake_darks_and_flats = False,
-	nonlinearity_fname = None, mask_channels = []):
+	nonlinearity_fname = None, mask_channels = [], workers = 1,
+	mem_limit = 512*2**20, dtype = np.float64, resume = True,
+	sky_stride = 17):
 	"""Calibrates all science images. 
 	
 	Parameters
@@ -59,6 +72,27 @@ def calibrate_all(raw_dir, calib_dir, dump_dir, science_ranges, dark_ranges,
 		whether or not to remake the darks and flats
         nonlinearity_fname : string or None, optional
 		path to the file with the nonlinearity correction coefficients
+	workers : int, optional
+		number of processes over which the science frames are spread,
+		and of threads used to build the master frames. 1 (the
+		default) reduces the frames serially
+	mem_limit : int, optional
+		approximate memory budget in bytes for combining the dark and
+		flat sequences, and for the blocks of science frames that are
+		calibrated together
+	dtype : data-type, optional
+		floating point type in which the frames are held from read to
+		write, including the saved masters and calibrated frames.
+		np.float32 halves memory traffic and disk usage; medians and
+		statistics agree with np.float64 to float32 precision
+	resume : boolean, optional
+		whether to skip frames that the calibration journal in dump_dir
+		records as already calibrated with the same masters and
+		settings, taking their covariates from the journal. This lets
+		an interrupted run pick up where it stopped
+	sky_stride : int, optional
+		subsampling stride of the sky estimate in 'median' mode (see
+		estimate_sky_level); 1 uses every pixel
 	
 	Returns
 	-------
@@ -71,7 +105,8 @@ def calibrate_all(raw_dir, calib_dir, dump_dir, science_ranges, dark_ranges,
 	#making/loading darks and flats
 	flat, darks, bp, hps = make_darks_and_flats(raw_dir, calib_dir, 
 		dark_ranges, dark_for_flat_range, flat_range, style,
-		remake_darks_and_flats)
+		remake_darks_and_flats, mem_limit = mem_limit, dtype = dtype,
+		workers = workers)
 
 	#making mcf
 	mcf = None
@@ -91,7 +126,9 @@ def calibrate_all(raw_dir, calib_dir, dump_dir, science_ranges, dark_ranges,
 			hps[dark_index], bkg_filename, destripe, style,
 			background_mode, correct_nonlinearity,
 			nonlinearity_fname, mcf, covariates,
-			mask_channels)
+			mask_channels, workers = workers, mem_limit = mem_limit,
+			dtype = dtype, dump_dir = dump_dir, resume = resume,
+			sky_stride = sky_stride)
 
 	save_covariates(dump_dir, covariates)
 
@@ -101,7 +138,9 @@ def calibrate_all(raw_dir, calib_dir, dump_dir, science_ranges, dark_ranges,
 
 def calibrate_sequence(raw_dir, calib_dir, science_sequence, flat, dark, bp, hp,
 	bkg, destripe, style, background_mode, correct_nonlinearity,
-	nonlinearity_fname, mcf, covariates, mask_channels):
+	nonlinearity_fname, mcf, covariates, mask_channels, workers = 1,
+	mem_limit = 512*2**20, dtype = np.float64, dump_dir = None,
+	resume = True, sky_stride = 17):
 	"""Calibrates all images in a science sequence.
 	
 	Parameters
@@ -141,80 +180,476 @@ def calibrate_sequence(raw_dir, calib_dir, science_sequence, flat, dark, bp, hp,
 	save_bkg : boolean
 		flag that indicates whether median values subtracted as
 		background should be saved or not. If True, saves to dump_dir
+	workers : int, optional
+		number of processes over which the frames are spread. Each
+		process writes its own calibrated frames; covariates are
+		returned in frame order regardless of the number of workers
+	mem_limit : int, optional
+		approximate memory budget in bytes, shared between the workers,
+		for the blocks of frames that are calibrated together
+	dtype : data-type, optional
+		floating point type of the calibrated frames
+	dump_dir : string or None, optional
+		if given, every calibrated frame's output path, checksum and
+		covariates are appended to a crash-safe journal in dump_dir as
+		soon as its block is saved
+	resume : boolean, optional
+		whether frames the journal records as calibrated with the same
+		masters and settings are skipped
+	sky_stride : int, optional
+		subsampling stride of the sky estimate in 'median' mode (see
+		estimate_sky_level); 1 uses every pixel
 
 	Returns
 	-------
-	bkgs : array of floats
-		if save_bkg is True, this will be an array of floats containing
-		the saved median background of each image. if save_bkg is False,
-		this will just be an empty array.
+	covariates : dict of lists
+		the covariates dict passed in, with the values of every frame
+		of the sequence appended in frame order; 'bjd' holds BJD_TDB
+		floats
 	"""
+	covariate_keys = list(covariates.keys())
+	run_key = None
+	completed = {}
+	if dump_dir is not None:
+		run_key = _get_run_key(raw_dir, calib_dir, flat, dark, bp, hp,
+			bkg, nonlinearity_fname, style, destripe, background_mode,
+			mask_channels, covariate_keys, dtype, sky_stride)
+	if run_key is not None and resume:
+		journal = load_journal(dump_dir, run_key)
+		for i in science_sequence:
+			frame_covariates = _get_journaled_covariates(journal,
+				raw_dir, i, style, run_key)
+			if frame_covariates is not None:
+				completed[int(i)] = frame_covariates
+		if len(completed) > 0:
+			print(f"Resuming: {len(completed)} frames already " + \
+				"calibrated...")
+	to_calibrate = [i for i in science_sequence if int(i) not in completed]
+
+	state = _make_calib_state(raw_dir, calib_dir, flat, dark, bp, hp, bkg,
+		destripe, style, background_mode, nonlinearity_fname, mcf,
+		mask_channels, covariate_keys, dtype, run_key is not None,
+		sky_stride)
+
+	#frames are calibrated in memory-bounded blocks, and no worker is
+	#left without a block. A single process pipelines reads and writes,
+	#which keeps up to four more blocks in flight
+	block_size = get_block_size(mem_limit // workers,
+		itemsize = np.dtype(dtype).itemsize,
+		n_copies = 3 if workers > 1 else 7)
+	block_size = max(1, min(block_size,
+		-(-len(to_calibrate) // workers)))
+	blocks = [to_calibrate[j:j + block_size] for j in \
+		range(0, len(to_calibrate), block_size)]
+
+	for block, results in zip(blocks,
+		_calibrate_blocks(blocks, state, workers)):
+		completed.update(_journal_block(dump_dir, run_key, raw_dir,
+			style, block, results))
+
+	#BJDs of the whole sequence are computed in one batch
+	frames = [completed[int(i)] for i in science_sequence]
+	for key in covariates.keys():
+		values = [frame[key] for frame in frames]
+		if key == 'bjd':
+			values = list(get_bjds(values))
+		covariates[key].extend(values)
+
+	return covariates 
+
+def _make_calib_state(raw_dir, calib_dir, flat, dark, bp, hp, bkg,
+	destripe, style, background_mode, nonlinearity_fname, mcf,
+	mask_channels, covariate_keys, dtype, journal, sky_stride = 17):
+	"""Loads the masters and builds the calibrator and everything else
+	_calibrate_block needs. Each worker process gets its own copy of
+	the state, and so its own frame buffers."""
 	flat, dark, bp, hp, nonlinearity_array, correct_nonlinearity = \
-		load_calib_files(flat,dark,bp,hp,nonlinearity_fname)
+		load_calib_files(flat,dark,bp,hp,nonlinearity_fname,
+		dtype = dtype)
 	if bkg is not None:
-		with fits.open(bkg) as hdul:
-			background_frame = hdul[0].data
+		background_frame = load_master_frame(bkg, dtype = dtype)
 	else:
 		background_frame = None
-	
-	for i in science_sequence:
-		image = get_img_name(raw_dir, i, style = style) 
+	calibrator = FrameCalibrator(flat, dark, bp, hp,
+		correct_nonlinearity = correct_nonlinearity,
+		nonlinearity_array = nonlinearity_array, destripe = destripe,
+		background_mode = background_mode,
+		background_frame = background_frame,
+		multicomponent_frame = mcf, mask_channels = mask_channels,
+		dtype = dtype, sky_stride = sky_stride)
+	return {'raw_dir': raw_dir, 'calib_dir': calib_dir, 'style': style,
+		'calibrator': calibrator, 'covariate_keys': covariate_keys,
+		'dtype': dtype, 'journal': journal}
+
+def _get_run_key(raw_dir, calib_dir, flat, dark, bp, hp, bkg,
+	nonlinearity_fname, style, destripe, background_mode, mask_channels,
+	covariate_keys, dtype, sky_stride = 17):
+	"""Digest of the masters and of every setting that changes the
+	calibrated frames or covariates, which keys the journal."""
+	inputs = [fname for fname in (flat, dark, bp, hp, bkg,
+		nonlinearity_fname) if fname is not None]
+	return get_product_digest(inputs, {'raw_dir': raw_dir,
+		'calib_dir': calib_dir, 'style': style, 'destripe': destripe,
+		'background_mode': background_mode,
+		'mask_channels': list(mask_channels),
+		'covariates': covariate_keys, 'dtype': np.dtype(dtype).name,
+		'sky_stride': sky_stride})
+
+def _get_journaled_covariates(journal, raw_dir, i, style, run_key):
+	"""Covariates of frame i if the journal shows it was calibrated in
+	this run from the same raw frame, and its output is unmodified;
+	None otherwise."""
+	entry = journal.get(int(i))
+	if entry is not None and check_journal_entry(entry) and \
+		entry['raw'] == _get_raw_key(raw_dir, i, style, run_key):
+		return entry['covariates']
+	return None
+
+def _journal_block(dump_dir, run_key, raw_dir, style, block, results):
+	"""Appends the results of _calibrate_block to the journal if the
+	run is journaled, returning the covariates keyed on frame number."""
+	block_covariates = {}
+	entries = []
+	for i, (frame_covariates, output) in zip(block, results):
+		block_covariates[int(i)] = frame_covariates
+		if run_key is not None:
+			entries.append(dict(output, run = run_key, frame = int(i),
+				covariates = frame_covariates,
+				raw = _get_raw_key(raw_dir, i, style, run_key)))
+	if len(entries) > 0:
+		append_journal(dump_dir, entries)
+	return block_covariates
+
+def _get_raw_key(raw_dir, i, style, run_key):
+	return get_product_digest([get_img_name(raw_dir, i, style = style)],
+		{'run': run_key})
+
+def _calibrate_blocks(blocks, state, workers):
+	"""Yields the results of _calibrate_block for each block in turn,
+	spreading the blocks over workers processes if workers > 1, and
+	pipelining reads, calibration and writes otherwise."""
+	if workers > 1:
+		with ProcessPoolExecutor(max_workers = workers,
+			initializer = _init_calib_worker,
+			initargs = (state,)) as pool:
+			yield from pool.map(_calibrate_block_in_worker, blocks)
+	else:
+		yield from _calibrate_blocks_pipelined(blocks, state)
+
+def _calibrate_blocks_pipelined(blocks, state, depth = 1):
+	"""Yields the results of _calibrate_block for each block in turn,
+	with the blocks read, calibrated and written in three overlapping
+	stages.
+
+	A reader thread prefetches the raw frames of the next blocks and a
+	writer thread saves the calibrated ones while the current block is
+	calibrated, so disk and CPU work overlap. The stages are connected
+	by queues holding at most depth blocks, so a slow disk or a slow
+	calibration holds back the other stages instead of piling up
+	frames in memory.
+
+	The raw and calibrated frames travel in two rings of depth + 1
+	block buffers, each handed back to its stage through a free queue
+	once the block has been calibrated or written, so no buffers are
+	allocated after the first blocks.
+	"""
+	read_queue = queue.Queue(maxsize = depth)
+	write_queue = queue.Queue(maxsize = depth)
+	done_queue = queue.Queue()
+	free_reads = queue.Queue()
+	free_writes = queue.Queue()
+	for _ in range(depth + 1):
+		#buffers are allocated on first use, when their shape is known
+		free_reads.put(None)
+		free_writes.put(None)
+	stop = threading.Event()
+
+	def read_blocks():
+		try:
+			for block in blocks:
+				buffer = free_reads.get()
+				if stop.is_set():
+					return
+				read_queue.put(_read_block(block, state, buffer))
+		except BaseException as e:
+			read_queue.put(e)
+
+	def write_blocks():
+		error = None
+		while True:
+			item = write_queue.get()
+			if item is None:
+				return
+			buffer, write_item = item
+			if error is None:
+				try:
+					done_queue.put(_write_block(*write_item, state))
+				except BaseException as e:
+					error = e
+					done_queue.put(e)
+			free_writes.put(buffer)
+
+	def get_done(block = True):
+		result = done_queue.get(block = block)
+		if isinstance(result, BaseException):
+			raise result
+		return result
+
+	threads = [threading.Thread(target = read_blocks, daemon = True),
+		threading.Thread(target = write_blocks, daemon = True)]
+	for thread in threads:
+		thread.start()
+	n_done = 0
+	try:
+		for block in blocks:
+			item = read_queue.get()
+			if isinstance(item, BaseException):
+				raise item
+			buffer, images, headers = item
+			calibs, retvals = state['calibrator'].calibrate_block(images,
+				headers)
+			free_reads.put(buffer)
+			#the calibrator's buffer is reused for the next block
+			buffer = _fit_buffer(free_writes.get(), calibs.shape,
+				calibs.dtype)
+			buffer[:len(calibs)] = calibs
+			write_queue.put((buffer, (block, buffer[:len(calibs)],
+				retvals, headers)))
+			while True:
+				try:
+					result = get_done(block = False)
+				except queue.Empty:
+					break
+				n_done += 1
+				yield result
+		while n_done < len(blocks):
+			result = get_done()
+			n_done += 1
+			yield result
+	finally:
+		#unblock and stop the reader and writer on early exit too
+		stop.set()
+		try:
+			read_queue.get_nowait()
+		except queue.Empty:
+			pass
+		free_reads.put(None)
+		write_queue.put(None)
+		for thread in threads:
+			thread.join()
+
+_calib_worker_state = None
+
+def _init_calib_worker(state):
+	global _calib_worker_state
+	_calib_worker_state = state
+
+def _calibrate_block_in_worker(block):
+	return _calibrate_block(block, _calib_worker_state)
+
+def _calibrate_block(block, state):
+	"""Calibrates and saves a block of science frames, returning each
+	frame's covariate values and, if the run is journaled, the path,
+	checksum and file stats of its calibrated frame."""
+	images = [get_img_name(state['raw_dir'], i, style = state['style']) \
+		for i in block]
+	for image in images:
 		print(f"Reducing {image}...")
-		calib, covariates = calibrate_image(image, flat, dark, bp, hp,
-			correct_nonlinearity = correct_nonlinearity,
-			nonlinearity_array = nonlinearity_array,
-			destripe = destripe, background_mode = background_mode,
-			background_frame = background_frame,
-			multicomponent_frame = mcf,
-			covariate_dict = covariates,
-			mask_channels = mask_channels)
-		outname = get_img_name(calib_dir, i, style = style)
-		save_image(calib, outname)
+	calibs, retvals, headers = state['calibrator'].calibrate_files(images)
+	return _write_block(block, calibs, retvals, headers, state)
 
-	return covariates 
+def _read_block(block, state, buffer = None):
+	"""Reads the raw frames and headers of a block of science frames
+	into buffer, which is reallocated if it cannot hold them. Returns
+	the buffer, the frames as a view of it and the headers."""
+	headers = []
+	for k, i in enumerate(block):
+		image = get_img_name(state['raw_dir'], i, style = state['style'])
+		print(f"Reducing {image}...")
+		with fits.open(image) as hdul:
+			data = hdul[0].data
+			if k == 0:
+				buffer = _fit_buffer(buffer,
+					(len(block),) + data.shape, data.dtype)
+			buffer[k] = data
+			headers.append(hdul[0].header)
+	return buffer, buffer[:len(block)], headers
 
-###Checking saved versions###
-def check_saved(dirname, dark_seqs, flat_seq, style):
-	darks = []
-	hps = []
-	for dark in dark_seqs:
-		num = dark[-1]
-		zeros = '0'*(4-len(str(num)))
-		darkname = f'{dirname}{style}{zeros}{num}' + \
-			'_combined_dark.fits'
-		hpname = f'{dirname}{style}{zeros}{num}' + \
-			'_combined_hp_map.fits'
-		darks.append(darkname)
-		hps.append(hpname)
-		hdul = fits.open(darkname)
-		hdul.close()
-		hdul = fits.open(hpname)
-		hdul.close()
-
-	num = flat_seq[-1]
-	zeros = '0'*(4 - len(str(num)))
-	flatname = f'{dirname}{style}{zeros}{num}' + \
-		'_combined_flat.fits'
-	bpname = f'{dirname}{style}{zeros}{num}' + \
-		'_combined_bp_map.fits'
-	hdul = fits.open(flatname)
-	hdul.close()
-	hdul = fits.open(bpname)
-	hdul.close()
-
-	print("Loaded saved darks and flats...")
-	return flatname, darks, bpname, hps
-
-def check_saved_background(imname):
-	hdul = fits.open(imname)
-	hdul.close()
-	print("Loaded saved background file...")
-	return imname
+def _fit_buffer(buffer, shape, dtype):
+	"""buffer if it can hold an array of the given shape and dtype in
+	its leading frames, else a new buffer of that shape."""
+	if buffer is None or buffer.dtype != dtype or \
+		buffer.shape[1:] != shape[1:] or len(buffer) < shape[0]:
+		buffer = np.empty(shape, dtype = dtype)
+	return buffer
+
+def _write_block(block, calibs, retvals, headers, state):
+	"""Saves a block of calibrated frames, returning the results of
+	_calibrate_block."""
+	results = []
+	for i, calib, retval, header in zip(block, calibs, retvals, headers):
+		frame_covariates = _get_frame_covariates(
+			state['covariate_keys'], header, retval)
+		outname = get_img_name(state['calib_dir'], i,
+			style = state['style'])
+		save_image(calib, outname, dtype = state['dtype'])
+		output = None
+		if state['journal']:
+			stat = os.stat(outname)
+			output = {'path': outname,
+				'sha256': get_file_checksum(outname),
+				'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+		results.append((frame_covariates, output))
+	return results
+
+def get_block_size(mem_limit, shape = (2048, 2048), itemsize = 8,
+	n_copies = 3):
+	"""Number of frames calibrated at once such that n_copies blocks --
+	the block buffers, the temporaries of the per-frame reductions and
+	any blocks in flight in a pipeline -- fit in mem_limit bytes."""
+	return max(1, mem_limit // (n_copies*shape[0]*shape[1]*itemsize))
+
+###Live calibration###
+
+def calibrate_watch(raw_dir, calib_dir, dump_dir, first_frame, dark_range,
+	dark_for_flat_range, flat_range, last_frame = None, destripe = True,
+	style = 'wirc', background_mode = None, bkg_filename = None,
+	nonlinearity_fname = None, mask_channels = [], dtype = np.float64,
+	poll_interval = 1., settle_time = 1., timeout = None,
+	sky_stride = 17):
+	"""Calibrates science frames as they are written into raw_dir, for
+	quick-look reductions during the night.
+
+	raw_dir is polled for the next frame number in get_img_name
+	numbering, starting from first_frame. A frame is calibrated once it
+	has not been modified for settle_time seconds and holds a complete
+	FITS image, and a frame number is skipped if the next one has
+	appeared without it. After every frame its covariates are appended
+	to the calibration journal and the covariate files in dump_dir are
+	rewritten, so they always cover every frame reduced so far. Frames
+	the journal shows were already calibrated with the same masters and
+	settings are not reduced again, so an interrupted watch can simply
+	be restarted.
+
+	Parameters
+	------
+	raw_dir : string
+		path to the directory into which the raw frames are written
+	calib_dir : string
+		path to the directory into which the calibrated frames will be
+		stored
+	dump_dir : string
+		path to the directory in which the covariates and the
+		calibration journal are stored
+	first_frame : int
+		number of the first science frame
+	dark_range : tuple of ints
+		a tuple (int1, int2) that defines the linear sequence of darks
+		used to calibrate the science frames
+	dark_for_flat_range, flat_range : tuples of ints
+		as for calibrate_all
+	last_frame : int or None, optional
+		number of the last science frame; None keeps watching until
+		timeout or a keyboard interrupt
+	poll_interval : float, optional
+		seconds between polls of raw_dir
+	settle_time : float, optional
+		seconds a frame must be left unmodified before it is read
+	timeout : float or None, optional
+		stop if no new frame has arrived for this many seconds. None
+		waits indefinitely
+	the remaining parameters are as for calibrate_all
+
+	Returns
+	-------
+	calib_dir : string
+		path to the directory contained calibrated science images
+	"""
+	flat, darks, bp, hps = make_darks_and_flats(raw_dir, calib_dir,
+		[dark_range], dark_for_flat_range, flat_range, style, False,
+		dtype = dtype)
+	mcf = None
+	if background_mode == 'helium':
+		mcf = construct_multicomponent_frame(calib_dir, dump_dir)
+
+	covariates = {'bkgs': [], 'bjd': [], 'AIRMASS': []}
+	covariate_keys = list(covariates.keys())
+	run_key = _get_run_key(raw_dir, calib_dir, flat, darks[0], bp, hps[0],
+		bkg_filename, nonlinearity_fname, style, destripe,
+		background_mode, mask_channels, covariate_keys, dtype,
+		sky_stride)
+	journal = load_journal(dump_dir, run_key)
+	state = _make_calib_state(raw_dir, calib_dir, flat, darks[0], bp,
+		hps[0], bkg_filename, destripe, style, background_mode,
+		nonlinearity_fname, mcf, mask_channels, covariate_keys, dtype,
+		True, sky_stride)
+
+	i = first_frame
+	last_arrival = time.time()
+	print(f"Watching {raw_dir} from frame {first_frame}...")
+	try:
+		while last_frame is None or i <= last_frame:
+			im_name = get_img_name(raw_dir, i, style = style)
+			if frame_is_complete(im_name, settle_time):
+				frame_covariates = _get_journaled_covariates(journal,
+					raw_dir, i, style, run_key)
+				if frame_covariates is None:
+					results = _calibrate_block([i], state)
+					frame_covariates = _journal_block(dump_dir, run_key,
+						raw_dir, style, [i], results)[i]
+				for key in covariate_keys:
+					value = frame_covariates[key]
+					if key == 'bjd':
+						value = get_bjds([value])[0]
+					covariates[key].append(value)
+				save_covariates(dump_dir, covariates)
+				i += 1
+				last_arrival = time.time()
+			elif not os.path.exists(im_name) and os.path.exists(
+				get_img_name(raw_dir, i + 1, style = style)):
+				print(f"Frame {i} is missing, skipping...")
+				i += 1
+			elif timeout is not None and \
+				time.time() - last_arrival > timeout:
+				print(f"No new frames in {timeout} s...")
+				break
+			else:
+				time.sleep(poll_interval)
+	except KeyboardInterrupt:
+		print("Watch interrupted...")
+
+	print(f"WATCH STOPPED AFTER {len(covariates['bkgs'])} FRAMES")
+	return calib_dir
+
+def frame_is_complete(fname, settle_time = 1.):
+	"""True once fname has not been modified for settle_time seconds
+	and is long enough to hold the data its primary header
+	describes."""
+	try:
+		stat = os.stat(fname)
+	except FileNotFoundError:
+		return False
+	if time.time() - stat.st_mtime < settle_time:
+		return False
+	try:
+		with warnings.catch_warnings():
+			#truncated files are expected while a frame is written
+			warnings.simplefilter('ignore')
+			with fits.open(fname) as hdul:
+				header = hdul[0].header
+				n_data = abs(header['BITPIX'])//8*int(np.prod(
+					[header[f'NAXIS{k}'] for k in \
+					range(1, header['NAXIS'] + 1)]))
+				n_header = len(header.tostring())
+	except (OSError, ValueError, KeyError):
+		return False
+	return stat.st_size >= n_header + n_data
 
 ###Flats and Darks###
 
 def make_darks_and_flats(dirname, calib_dir, dark_seqs, dark_for_flat_seq,
-	flat_seq, style, remake_darks_and_flats = True):
+	flat_seq, style, remake_darks_and_flats = True,
+	mem_limit = 512*2**20, dtype = np.float64, workers = 1):
 	"""Creates combined dark, dark for flat, and combined flat.
 	
 	Parameters
@@ -234,6 +669,20 @@ def make_darks_and_flats(dirname, calib_dir, dark_seqs, dark_for_flat_seq,
 	style : string, optional
 		the prefix for the image number. usually 'image' or 'wirc'
 		unless otherwise specified during observations. 
+	mem_limit : int, optional
+		approximate memory budget in bytes for combining each
+		sequence; see make_combined_image
+	dtype : data-type, optional
+		floating point type of the combined frames
+	workers : int, optional
+		number of threads over which the stacks and pixel maps are
+		computed
+
+	Each product is recorded in a manifest in calib_dir along with a
+	digest of its input frames, their file stats and the parameters it
+	was made with. Unless remake_darks_and_flats is True, a saved
+	product is reused only if that digest is unchanged, so only the
+	products whose inputs changed are rebuilt.
 
 	Returns
 	-------
@@ -246,36 +695,73 @@ def make_darks_and_flats(dirname, calib_dir, dark_seqs, dark_for_flat_seq,
 	hps : list of strings
 		paths to the hot pixel files from the combined darks
 	"""
-	#check if saved versions exist
-	if not remake_darks_and_flats:
-		try:
-			return check_saved(calib_dir, dark_seqs,
-				flat_seq, style)
-		except FileNotFoundError as e:
-			print("Can't find saved darks/flats -- remaking...")
-
-	temp,_ = make_combined_image(dirname, calib_dir, *dark_for_flat_seq,
-		style = style, calibration = 'dark')
-	print('DARK FOR FLAT CREATED')
-	flat,bp = make_combined_image(dirname, calib_dir, *flat_seq,
-		style = style, calibration = 'flat', dark_for_flat_name = temp)
-	print('COMBINED FLAT CREATED')
+	manifest = load_manifest(calib_dir)
+	temp,_ = _make_combined_product(manifest, dirname, calib_dir,
+		dark_for_flat_seq, 'dark', style, remake_darks_and_flats,
+		mem_limit, dtype, message = 'DARK FOR FLAT CREATED',
+		workers = workers)
+	flat,bp = _make_combined_product(manifest, dirname, calib_dir,
+		flat_seq, 'flat', style, remake_darks_and_flats, mem_limit,
+		dtype, dark_for_flat_name = temp,
+		message = 'COMBINED FLAT CREATED', workers = workers)
 	
 	darks = []
 	hps = []
 	for seq in dark_seqs:
-		dark, hp = make_combined_image(dirname, calib_dir, *seq,
-			style = style, calibration = 'dark')
+		#a dark sequence that doubles as the dark for the flat was
+		#just remade above and does not need remaking again
+		remake = remake_darks_and_flats and \
+			tuple(seq) != tuple(dark_for_flat_seq)
+		dark, hp = _make_combined_product(manifest, dirname,
+			calib_dir, seq, 'dark', style, remake, mem_limit,
+			dtype, message = 'COMBINED DARK CREATED',
+			workers = workers)
 		darks.append(dark)
 		hps.append(hp)
-		print('COMBINED DARK CREATED')
 			
 	return flat, darks, bp, hps
 
+def _make_combined_product(manifest, dirname, calib_dir, seq, calibration,
+	style, remake, mem_limit, dtype, dark_for_flat_name = None,
+	message = '', workers = 1):
+	"""Makes a combined dark or flat and its pixel map with
+	make_combined_image, unless the manifest shows that saved versions
+	were made from the same inputs."""
+	map_type = 'hp_map' if calibration == 'dark' else 'bp_map'
+	products = [get_img_name(calib_dir, seq[-1], style = style,
+		img_type = f'combined_{img_type}') for img_type in \
+		(calibration, map_type)]
+	inputs = [get_img_name(dirname, i, style = style) for \
+		i in range(seq[0], seq[1] + 1)]
+	if dark_for_flat_name is not None:
+		inputs.append(dark_for_flat_name)
+	digest = get_product_digest(inputs, {'calibration': calibration,
+		'dtype': np.dtype(dtype).name})
+	if not remake and check_product(manifest, products, digest):
+		print(f"Loaded saved {products[0]}...")
+		return products
+
+	products = make_combined_image(dirname, calib_dir, *seq,
+		style = style, calibration = calibration,
+		dark_for_flat_name = dark_for_flat_name, mem_limit = mem_limit,
+		dtype = dtype, workers = workers)
+	record_product(manifest, products, digest)
+	save_manifest(calib_dir, manifest)
+	print(message)
+	return products
+
 def make_combined_image(dirname, calib_dir, seq_start, seq_end,
-	calibration = 'dark', dark_for_flat_name = None, style = 'wirc'):
+	calibration = 'dark', dark_for_flat_name = None, style = 'wirc',
+	mem_limit = 512*2**20, dtype = np.float64, workers = 1):
 	"""Given a dark or flat sequence, constructs a combined frame.
 
+	The frames are streamed into a memory-mapped, tile-major scratch
+	cube in calib_dir, and the median (and, for darks, the hot pixel
+	MAD) is computed one tile of detector rows at a time, so the peak
+	memory use is set by mem_limit rather than by the sequence length.
+	The tiles, and the row tiles of the bad pixel map, are processed on
+	workers threads.
+
 	Parameters
 	------
 	dirname : string
@@ -294,6 +780,13 @@ def make_combined_image(dirname, calib_dir, seq_start, seq_end,
 	style : string, optional
 		the prefix for the image number. usually 'image' or 'wirc'
 		unless otherwise specified during observations. 
+	mem_limit : int, optional
+		approximate memory budget in bytes for the in-memory tiles
+		of the stack and the temporaries made while reducing them
+	dtype : data-type, optional
+		floating point type of the stack and the combined frame
+	workers : int, optional
+		number of threads; mem_limit is shared between them
 
 	Returns
 	-------
@@ -306,29 +799,32 @@ def make_combined_image(dirname, calib_dir, seq_start, seq_end,
 
 	image_list = [get_img_name(dirname, i, style = style) for \
 		i in range(seq_start, seq_end + 1)]
-	stack = np.zeros([2048, 2048, len(image_list)])
-	for i,name in enumerate(image_list):
-		with fits.open(name) as hdul:
-			temp = hdul[0].data
-		print(f"Stacking image {name}...")
+	dark_for_flat = None
+	if calibration != 'dark':
+		dark_for_flat = load_master_frame(dark_for_flat_name)
+	tile_rows = get_tile_rows(len(image_list), mem_limit // workers,
+		itemsize = np.dtype(dtype).itemsize)
+	with tempfile.TemporaryDirectory(dir = calib_dir) as scratch_dir:
+		cube = stream_to_tile_cube(
+			_combine_frames(image_list, dark_for_flat),
+			len(image_list), scratch_dir + '/stack.dat', tile_rows,
+			dtype = dtype)
+		combined = reduce_tile_cube(cube, np.nanmedian,
+			workers = workers)
 		if calibration == 'dark':
-			stack[:,:,i] = temp
-		else:
-			with fits.open(dark_for_flat_name) as hdul:
-				dark_for_flat = hdul[0].data
-			dark_corr = temp - dark_for_flat
-			stack[:,:,i] = dark_corr/np.nanmedian(
-				dark_corr.flatten())
-	combined = np.nanmedian(stack, axis = 2)
+			print("Generating hot pixel map...")
+			MAD = reduce_tile_cube(cube, median_absolute_deviation,
+				workers = workers)
+		del cube
+
 	if calibration == 'dark':
-		print("Generating hot pixel map...")
-		hp = get_hot_px(stack) 
+		hp = get_hot_px_from_mad(MAD)
 		bpname = f'{calib_dir}{style}{zeros}{seq_end}'
 		bpname += f'_combined_hp_map.fits'
 		save_image(hp, bpname)
 	else:
 		print("Generating bad pixel map...")
-		bp = get_bad_px(combined)
+		bp = get_bad_px(combined, workers = workers)
 		bpname = f'{calib_dir}{style}{zeros}{seq_end}'
 		bpname += f'_combined_bp_map.fits'
 		save_image(bp, bpname)
@@ -340,9 +836,96 @@ def make_combined_image(dirname, calib_dir, seq_start, seq_end,
 	save_image(combined, savename)
 	return savename, bpname
 
+def _combine_frames(image_list, dark_for_flat = None):
+	"""Yields the frames of a dark sequence, or the dark-corrected and
+	median-normalized frames of a flat sequence if dark_for_flat is
+	given."""
+	for name in image_list:
+		with fits.open(name) as hdul:
+			temp = hdul[0].data
+		print(f"Stacking image {name}...")
+		if dark_for_flat is None:
+			yield temp
+		else:
+			dark_corr = temp - dark_for_flat
+			yield dark_corr/np.nanmedian(dark_corr.flatten())
+
+###Tiled stacks###
+
+def get_tile_rows(n_frames, mem_limit, shape = (2048, 2048), itemsize = 8):
+	"""Number of detector rows per tile such that one tile of an
+	n_frames stack, together with the temporaries made while taking its
+	median, fits within mem_limit bytes."""
+	row_bytes = 4*n_frames*shape[1]*itemsize
+	return int(np.clip(mem_limit // row_bytes, 1, shape[0]))
+
+def stream_to_tile_cube(frames, n_frames, scratch_name, tile_rows,
+	shape = (2048, 2048), dtype = float):
+	"""Writes a stream of frames into a memory-mapped scratch cube of
+	shape (n_tiles, n_frames, tile_rows, ncols), so that every tile of
+	detector rows is contiguous on disk for the whole stack.
+
+	Parameters
+	------
+	frames : iterable of arrays
+		the frames to be stacked, each of the given shape
+	n_frames : int
+		number of frames in the stream
+	scratch_name : string
+		path to the scratch file backing the cube
+	tile_rows : int
+		number of detector rows per tile
+	shape : tuple of ints, optional
+		shape of a single frame
+	dtype : data-type, optional
+		data type of the scratch cube
+
+	Returns
+	-------
+	cube : np.memmap
+		the tile-major scratch cube. The last tile is padded if
+		tile_rows does not divide the number of rows
+	"""
+	n_tiles = -(-shape[0] // tile_rows)
+	cube = np.memmap(scratch_name, dtype = dtype, mode = 'w+',
+		shape = (n_tiles, n_frames, tile_rows, shape[1]))
+	for i, frame in enumerate(frames):
+		for t in range(n_tiles):
+			rows = frame[t*tile_rows:(t + 1)*tile_rows]
+			cube[t, i, :len(rows)] = rows
+	cube.flush()
+	return cube
+
+def reduce_tile_cube(cube, func, n_rows = 2048, workers = 1):
+	"""Reduces a tile-major scratch cube along the frame axis, one tile
+	at a time, with func(tile, axis = 0). With workers > 1 the tiles
+	are reduced concurrently on that many threads, so up to workers
+	tiles are in memory at once. Returns an (n_rows, ncols) frame of
+	the cube's dtype."""
+	n_tiles, _, tile_rows, n_cols = cube.shape
+	reduced = np.empty((n_rows, n_cols), dtype = cube.dtype)
+
+	def reduce_tile(t):
+		start = t*tile_rows
+		stop = min(start + tile_rows, n_rows)
+		tile = np.asarray(cube[t, :, :stop - start])
+		reduced[start:stop] = func(tile, axis = 0)
+
+	if workers > 1:
+		with ThreadPoolExecutor(max_workers = workers) as pool:
+			list(pool.map(reduce_tile, range(n_tiles)))
+	else:
+		for t in range(n_tiles):
+			reduce_tile(t)
+	return reduced
+
 def get_hot_px(dark_stack, sig_hot_pix = 5):
 	"original implement by WIRC+Pol team"
 	MAD = median_absolute_deviation(dark_stack, axis = 2)
+	return get_hot_px_from_mad(MAD, sig_hot_pix)
+
+def get_hot_px_from_mad(MAD, sig_hot_pix = 5):
+	"""Flags hot pixels from a per-pixel MAD frame of a dark stack."""
 	hot_px = sigma_clip(MAD, sigma = sig_hot_pix)
 	return np.array(hot_px.mask, dtype = 'int')
 
@@ -355,9 +938,17 @@ def stddevFilter(img, box_size):
 	return np.sqrt(wsqrmean - wmean*wmean)
 
 def get_bad_px(flat, local_sig_bad_pix = 3, global_sig_bad_pix = 9,
-	local_box_size = 11):
-	"original implement by WIRC+Pol team"
-	median_flat = median_filter(flat, local_box_size)
+	local_box_size = 11, workers = 1):
+	"""original implement by WIRC+Pol team. Always evaluated in float64,
+	since the moving standard deviation cancels catastrophically in
+	float32. The median filter, which dominates the cost, runs in row
+	tiles on workers threads; the moving standard deviation uses
+	running sums whose rounding depends on where they start, so it is
+	kept whole-frame to leave the map independent of workers."""
+	flat = np.asarray(flat, dtype = np.float64)
+	median_flat = filter_row_tiles(
+		lambda tile: median_filter(tile, local_box_size), flat,
+		local_box_size // 2, workers = workers)
 	stddev_im = stddevFilter(flat, local_box_size)
 	local_bad_pix = np.abs(median_flat - flat) > local_sig_bad_pix*stddev_im
 	pix_to_pix = flat/median_flat
@@ -368,13 +959,97 @@ def get_bad_px(flat, local_sig_bad_pix = 3, global_sig_bad_pix = 9,
 	bad_px = np.logical_or(bad_px, non_positive)
 	return np.array(bad_px, dtype = 'int')
 
-def clean_bad_pix(image, bad_px_map, replacement_box = 5):
-	"original implement by WIRC+Pol team"
-	bad_px_map = np.logical_or(bad_px_map, image <= 0)
-	bad_px_map = np.logical_or(bad_px_map, ~np.isfinite(image))
-	med_fil = median_filter(image, size = replacement_box)
-	cleaned = image*~bad_px_map + med_fil*bad_px_map
-	return cleaned
+def filter_row_tiles(func, image, halo, workers = 1):
+	"""Applies the neighbourhood filter func to image in tiles of rows,
+	each padded with halo rows of its neighbours, on workers threads.
+
+	The result is identical to func(image) as long as func only looks
+	up to halo rows away and applies the same edge handling to the
+	tiles at the image edges as to the whole image, as scipy.ndimage
+	filters do.
+	"""
+	if workers <= 1:
+		return func(image)
+	n_rows = len(image)
+	#a few tiles per thread keeps the threads busy to the end
+	tile_rows = -(-n_rows // (4*workers))
+	out = np.empty_like(image)
+
+	def filter_tile(start):
+		stop = min(start + tile_rows, n_rows)
+		lo = max(start - halo, 0)
+		hi = min(stop + halo, n_rows)
+		out[start:stop] = func(image[lo:hi])[start - lo:stop - lo]
+
+	with ThreadPoolExecutor(max_workers = workers) as pool:
+		list(pool.map(filter_tile, range(0, n_rows, tile_rows)))
+	return out
+
+def clean_bad_pix(image, bad_px_map, replacement_box = 5,
+	bad_px_index = None, out = None):
+	"""original implement by WIRC+Pol team. Replaces flagged pixels with
+	the median of the surrounding replacement_box x replacement_box box,
+	evaluating the median only at the flagged pixels. bad_px_index, as
+	returned by make_bad_px_index, holds the precomputed neighbour
+	lists of the static bad pixels in bad_px_map, which may be of any
+	dtype; nonzero entries are flagged. If out is given the cleaned
+	frame is written into it, which may be image itself.
+
+	Non-finite neighbours are left out of the medians, whereas
+	scipy.ndimage.median_filter, used by earlier versions, gives
+	ill-defined results for boxes holding NaNs. Non-finite pixels
+	themselves are set to NaN, as before."""
+	bad_px_map = np.asarray(bad_px_map, dtype = bool)
+	if bad_px_index is None:
+		bad_px_index = make_bad_px_index(bad_px_map, replacement_box)
+	frame_px, frame_neighbours = make_bad_px_index(
+		(image <= 0) & ~bad_px_map, replacement_box)
+	px = np.concatenate((bad_px_index[0], frame_px))
+	neighbours = np.concatenate((bad_px_index[1], frame_neighbours))
+
+	meds = batched_nanmedian(np.ravel(image)[neighbours], axis = 1)
+	non_finite = ~np.isfinite(image)
+	if out is None:
+		out = np.array(image, dtype = _float_dtype(image))
+	elif out is not image:
+		out[...] = image
+	out.flat[px] = meds
+	#non-finite pixels are not recoverable and stay flagged as NaN
+	out[non_finite] = np.nan
+	return out
+
+def make_bad_px_index(bad_px_map, replacement_box = 5):
+	"""Flat indices of the flagged pixels and of the pixels in the
+	replacement_box x replacement_box box around each of them, with the
+	box reflected at the detector edges as in
+	scipy.ndimage.median_filter.
+
+	Returns
+	-------
+	px : array of ints, shape(n_bad)
+		flat indices of the flagged pixels
+	neighbours : array of ints, shape(n_bad, replacement_box**2)
+		flat indices of the box around each flagged pixel
+	"""
+	n_rows, n_cols = np.shape(bad_px_map)
+	rows, cols = np.nonzero(bad_px_map)
+	offsets = np.arange(replacement_box) - replacement_box // 2
+	box_rows = _reflect_index(rows[:,None] + offsets, n_rows)
+	box_cols = _reflect_index(cols[:,None] + offsets, n_cols)
+	neighbours = box_rows[:,:,None]*n_cols + box_cols[:,None,:]
+	px = rows*n_cols + cols
+	return px, neighbours.reshape(len(px), replacement_box**2)
+
+def _float_dtype(arr):
+	"""Native-endian dtype of arr if it is floating point, float64
+	otherwise."""
+	if np.issubdtype(arr.dtype, np.floating):
+		return arr.dtype.newbyteorder('=')
+	return np.dtype(np.float64)
+
+def _reflect_index(idx, n):
+	idx = np.where(idx < 0, -idx - 1, idx)
+	return np.where(idx >= n, 2*n - idx - 1, idx)
 
 ###Background construction###
 
@@ -382,125 +1057,497 @@ def make_calibrated_bkg_image(data_dir, calib_dir, bkg_seq, dark_ranges,
 	dark_for_flat_range, flat_range, naming_style = 'wirc', 
 	nonlinearity_fname = None, sigma_lower = 5, 
 	sigma_upper = 3, plot = False, remake_bkg = False,
-	remake_darks_and_flats = False):
+	remake_darks_and_flats = False, mem_limit = 512*2**20,
+	dtype = np.float64, workers = 1):
+	"""Constructs a background frame from the sigma-clipped, median
+	scaled frames of a background sequence.
+
+	The clipped frames are streamed as NaN-masked float32 into a
+	memory-mapped, tile-major scratch cube in calib_dir, and the median
+	is taken one tile of detector rows at a time on workers threads, so
+	the memory use is set by mem_limit rather than by the sequence
+	length. Pixels clipped in every frame are set to 0."""
 
 	image_list = [get_img_name(data_dir, i,
 		style = naming_style) for \
 		i in range(bkg_seq[0], bkg_seq[1] + 1)]
 	imname = get_img_name(calib_dir, bkg_seq[-1],
 		style = naming_style, img_type = 'calibrated_background')
-	if not remake_bkg:
-		try:
-			return check_saved_background(imname)
-		except FileNotFoundError as e:
-			print("Can't find saved background -- remaking...")
 
-	print("Creating background frame...")
 	#create/load up flats and darks
 	flat, darks, bp, hps = make_darks_and_flats(data_dir, calib_dir,
 		dark_ranges, dark_for_flat_range, flat_range, naming_style,
-		remake_darks_and_flats)
+		remake_darks_and_flats, mem_limit = mem_limit, dtype = dtype,
+		workers = workers)
 	dark = darks[0]
 	hp = hps[0]
+
+	#the background is only remade if its frames, the masters or the
+	#clipping parameters changed since it was saved
+	manifest = load_manifest(calib_dir)
+	inputs = image_list + [flat, dark, bp, hp]
+	if nonlinearity_fname is not None:
+		inputs.append(nonlinearity_fname)
+	digest = get_product_digest(inputs, {'sigma_lower': sigma_lower,
+		'sigma_upper': sigma_upper, 'dtype': np.dtype(dtype).name})
+	if not remake_bkg and check_product(manifest, [imname], digest):
+		print("Loaded saved background file...")
+		return imname
+
+	print("Creating background frame...")
 	flat, dark, bp, hp, nonlinearity_array, correct_nonlinearity = \
-		load_calib_files(flat,dark,bp,hp,nonlinearity_fname)
-	
-	i = 0
-	med_val = 0
-	clipped_ims = np.ma.zeros([2048,2048, len(image_list)])
+		load_calib_files(flat,dark,bp,hp,nonlinearity_fname,
+		dtype = dtype)
+
+	calibrator = FrameCalibrator(flat, dark, bp, hp,
+		correct_nonlinearity = correct_nonlinearity,
+		nonlinearity_array = nonlinearity_array, dtype = dtype)
+	tile_rows = get_tile_rows(len(image_list), mem_limit // workers,
+		itemsize = 4)
+	with tempfile.TemporaryDirectory(dir = calib_dir) as scratch_dir:
+		cube = stream_to_tile_cube(_clipped_bkg_frames(image_list,
+			calibrator, sigma_lower, sigma_upper, plot),
+			len(image_list), scratch_dir + '/stack.dat', tile_rows,
+			dtype = np.float32)
+		background = reduce_tile_cube(cube, batched_nanmedian,
+			workers = workers)
+		del cube
+	background[np.isnan(background)] = 0.
+
+	save_image(background, imname, dtype = dtype)
+	record_product(manifest, [imname], digest)
+	save_manifest(calib_dir, manifest)
+	print("BACKGROUND FRAME CREATED")
+
+	return imname
+
+def _clipped_bkg_frames(image_list, calibrator, sigma_lower, sigma_upper,
+	plot = False):
+	"""Yields the calibrated frames of a background sequence with
+	clipped pixels set to NaN, each scaled to the median level of the
+	first frame."""
+	med_val = None
 	for name in image_list:
 		print(f"Stacking image {name}...")
-		calib, _ = calibrate_image(name, flat, dark, bp, hp,
-			correct_nonlinearity = correct_nonlinearity,
-			nonlinearity_array = nonlinearity_array)
-		clipped = sigma_clip(calib,
-			sigma_lower = sigma_lower,
+		calib, _, _ = calibrator.calibrate_file(name)
+		#the scale is the median of the whole frame, including the
+		#pixels that are clipped below
+		frame_med = np.nanmedian(calib)
+		if med_val is None:
+			med_val = frame_med
+		clipped = batched_sigma_clip(calib, sigma_lower = sigma_lower,
 			sigma_upper = sigma_upper)
 		if plot:
 			plt.figure(figsize = (8,8))
 			plt.imshow(clipped, origin = 'lower', vmin = 0, vmax = 70e3, cmap = 'Blues')
 			plt.show()
-		if i == 0:
-			med_val = np.nanmedian(clipped.flatten())
-		scale_factor = med_val / np.nanmedian(clipped.flatten())
-		clipped *= scale_factor
-		clipped_ims[:,:,i] = clipped
-		i += 1
-
-	background = np.ma.median(clipped_ims, axis = -1)
-	save_image(background.filled(0.), imname)
-	print("BACKGROUND FRAME CREATED")
+		clipped *= med_val / frame_med
+		yield clipped
 
-	return imname
+###Batched statistics###
+
+def batched_sigma_clip(data, sigma = 3, maxiters = 5, axis = None,
+	cenfunc = 'median', sigma_lower = None, sigma_upper = None):
+	"""Iterative sigma clipping of many independent samples at once.
+
+	Clipped values are set to NaN in place, so that every sample along
+	axis is clipped with its own center and standard deviation in one
+	vectorized pass per iteration. The clipping criterion matches
+	astropy's sigma_clip (cenfunc = 'median') and scipy's sigmaclip
+	(cenfunc = 'mean').
+
+	Parameters
+	------
+	data : array_like of floats
+		the samples to be clipped; NaNs are treated as already clipped
+	sigma : float, optional
+		number of standard deviations at which to clip
+	maxiters : int or None, optional
+		maximum number of clipping iterations. If None, iterates
+		until no more values are clipped
+	axis : int, tuple of ints or None, optional
+		axis or axes along which each sample lies. None clips the
+		whole array as one sample
+	cenfunc : string, optional
+		either 'median' or 'mean'
+	sigma_lower, sigma_upper : float or None, optional
+		number of standard deviations for the lower and upper clipping
+		limits; None uses sigma
+
+	Returns
+	-------
+	data : array_like of floats
+		the input array with clipped values replaced by NaN
+	"""
+	cenfunc = batched_nanmedian if cenfunc == 'median' else np.nanmean
+	sigma_lower = sigma if sigma_lower is None else sigma_lower
+	sigma_upper = sigma if sigma_upper is None else sigma_upper
+	iterations = itertools.count() if maxiters is None else \
+		range(maxiters)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		for _ in iterations:
+			cen = cenfunc(data, axis = axis, keepdims = True)
+			std = np.nanstd(data, axis = axis, keepdims = True)
+			clip = (data < cen - sigma_lower*std) | \
+				(data > cen + sigma_upper*std)
+			if not clip.any():
+				break
+			data[clip] = np.nan
+	return data
+
+def batched_nanmedian(data, axis = None, keepdims = False):
+	"""np.nanmedian for many short samples at once. For a single axis
+	the samples are sorted together (NaNs sort last) and the middle
+	values picked out per sample, which avoids np.nanmedian's
+	per-sample Python loop; other axes fall back to np.nanmedian."""
+	if not isinstance(axis, int) or data.shape[axis] == 0:
+		return np.nanmedian(data, axis = axis, keepdims = keepdims)
+	srt = np.sort(data, axis = axis)
+	n = np.sum(~np.isnan(data), axis = axis, keepdims = True)
+	lower = np.take_along_axis(srt, np.maximum((n - 1)//2, 0), axis)
+	upper = np.take_along_axis(srt, np.maximum(n//2, 0), axis)
+	med = np.where(n > 0, (lower + upper)/2, np.nan)
+	if not keepdims:
+		med = np.squeeze(med, axis = axis)
+	return med
 
 ###Image calibration###
 
-def get_bjd(header):
-	date_in = header['UTSHUT']
-	target_pos = coord.SkyCoord(header['RA'], header['DEC'],
-		unit = (u.hourangle, u.deg), frame='icrs')
-	palomar = coord.EarthLocation.of_site('Palomar')
-	time=ap_time.Time(date_in, format='isot', scale='utc', location=palomar)
-	half_exptime=0.5*header['EXPTIME']*header['COADDS']/(24*3600)
+#Palomar Observatory (Hale telescope), bundled so that barycentric times
+#can be computed without reaching the astropy site registry
+PALOMAR = coord.EarthLocation.from_geodetic(lon = -116.865*u.deg,
+	lat = 33.3563*u.deg, height = 1706.*u.m)
+
+def get_bjd_inputs(header):
+	"""Header values needed to compute the BJD of a frame."""
+	return (header['UTSHUT'], header['RA'], header['DEC'],
+		header['EXPTIME'], header['COADDS'])
+
+def get_bjds(bjd_inputs):
+	"""Computes BJD_TDB at mid-exposure for a whole sequence of frames
+	in one vectorized astropy call.
+
+	Parameters
+	------
+	bjd_inputs : list of tuples
+		(UTSHUT, RA, DEC, EXPTIME, COADDS) header values of each frame,
+		as returned by get_bjd_inputs
+
+	Returns
+	-------
+	bjd_tdb : array of floats
+		the BJD_TDB of each frame
+	"""
+	if len(bjd_inputs) == 0:
+		return np.array([])
+	date_in, ra, dec, exptime, coadds = (list(vals) for vals in \
+		zip(*bjd_inputs))
+	target_pos = coord.SkyCoord(ra, dec, unit = (u.hourangle, u.deg),
+		frame = 'icrs')
+	time = ap_time.Time(date_in, format = 'isot', scale = 'utc',
+		location = PALOMAR)
+	half_exptime = 0.5*np.array(exptime)*np.array(coadds)/(24*3600)
 	ltt_bary = time.light_travel_time(target_pos)
-	time = time.tdb+ltt_bary
-	bjd_tdb = time.jd+half_exptime
+	time = time.tdb + ltt_bary
+	bjd_tdb = time.jd + half_exptime
 	return bjd_tdb
+
+def get_bjd(header):
+	return get_bjds([get_bjd_inputs(header)])[0]
 	
+def estimate_sky_level(image, stride = 17, sigma = 3, maxiters = 5):
+	"""Fast estimate of the sigma-clipped median of a frame, or of each
+	frame of a block.
+
+	The clipped median is computed on every stride-th pixel rather than
+	on the whole frame. With a stride coprime to the row length the
+	subsample walks diagonally across the detector, so it samples every
+	row, column and readout channel evenly.
+
+	Parameters
+	------
+	image : array_like, shape(2048, 2048) or shape(K, 2048, 2048)
+		the frame or block of frames; NaNs are ignored
+	stride : int, optional
+		spacing of the subsample in flattened pixels. 1 evaluates the
+		exact clipped median of the whole frame
+	sigma : float, optional
+		number of standard deviations at which to clip
+	maxiters : int or None, optional
+		maximum number of clipping iterations
+
+	Returns
+	-------
+	sky : float or array of floats, shape(K)
+		the sigma-clipped median of the subsample
+	sky_err : float or array of floats, shape(K)
+		the standard error of sky as an estimate of the full-frame
+		value, sqrt(pi/2)*std/sqrt(n) for the n unclipped samples
+	"""
+	image = np.asarray(image)
+	sample = np.array(image.reshape(image.shape[:-2] + (-1,))[...,::stride],
+		dtype = np.float64)
+	batched_sigma_clip(sample, sigma = sigma, maxiters = maxiters,
+		axis = -1)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		sky = batched_nanmedian(sample, axis = -1)
+		n = np.sum(~np.isnan(sample), axis = -1)
+		sky_err = np.sqrt(np.pi/2)*np.nanstd(sample, axis = -1) / \
+			np.sqrt(n)
+	if stride == 1:
+		sky_err = np.zeros_like(sky_err)
+	return sky[()], sky_err[()]
+
 def calibrate_image(im_name, flat, dark, bp, hp, correct_nonlinearity = False,
 	nonlinearity_array = None, destripe = False, background_mode = None,
 	background_frame = None, multicomponent_frame = None,
-	covariate_dict = None, mask_channels = []):
-	"image is file flat dark are numpy arrays"
-	with fits.open(im_name) as hdul:
-		hdu = hdul[0]
-		header = hdu.header
-		image = hdu.data
-	if correct_nonlinearity:
-		image = nonlinearity_correction(image, header,
-			nonlinearity_array)
-	dark_corr = image - dark
-	corr = dark_corr/flat
-	bad_px_map = np.logical_or(bp, hp)
-	cleaned = clean_bad_pix(corr, bad_px_map)
-	cleaned[~np.isfinite(cleaned)] = 0.
-	retval = None
-	if len(mask_channels) > 0:
-		cleaned = mask_bad_channels(cleaned, mask_channels)
-
-	if background_mode == 'median':
-		#simple sigma-clipped median removal
-		_, med, _ = sigma_clipped_stats(cleaned.flatten())
-		cleaned -= med
-		retval = med
-
-	elif background_mode == 'global':
-		#requires reduced background frame
-		scale = np.nanmedian(cleaned) / np.nanmedian(background_frame)
-		cleaned -= scale*background_frame
-		retval = scale
-
-	elif background_mode == 'helium':
-		#requires multicomponent frame and reduced background frame
-		cleaned, retval = helium_background_subtraction(cleaned,
-			background_frame, multicomponent_frame)	
-	
-	if destripe:
-		cleaned = destripe_image(cleaned)
-
+	covariate_dict = None, mask_channels = [], helium_model = None,
+	bad_px_index = None, dtype = np.float64, sky_stride = 17):
+	"""image is file flat dark are numpy arrays; the raw frame is
+	converted to dtype on read, and the frame's covariates (with 'bjd'
+	as a BJD_TDB float) are appended to covariate_dict if given. To
+	calibrate many frames against the same masters, build a
+	FrameCalibrator once and reuse it instead"""
+	calibrator = FrameCalibrator(flat, dark, bp, hp,
+		correct_nonlinearity = correct_nonlinearity,
+		nonlinearity_array = nonlinearity_array, destripe = destripe,
+		background_mode = background_mode,
+		background_frame = background_frame,
+		multicomponent_frame = multicomponent_frame,
+		mask_channels = mask_channels, helium_model = helium_model,
+		bad_px_index = bad_px_index, dtype = dtype,
+		sky_stride = sky_stride)
+	cleaned, retval, header = calibrator.calibrate_file(im_name)
 	if covariate_dict is not None:
-		for covariate in covariate_dict.keys():
-			if covariate == 'bjd':
-				covariate_dict[covariate].append(
-					get_bjd(header))
-			elif covariate == 'bkgs':
-				covariate_dict[covariate].append(retval)
-			else:
-				covariate_dict[covariate].append(
-					header[covariate])
+		record_covariates(covariate_dict, header, retval)
 
 	return cleaned, covariate_dict
 
+def record_covariates(covariate_dict, header, retval):
+	"""Appends a calibrated frame's covariates to covariate_dict;
+	retval is the background value(s) returned by the calibration."""
+	frame_covariates = _get_frame_covariates(covariate_dict.keys(),
+		header, retval)
+	if 'bjd' in frame_covariates:
+		frame_covariates['bjd'] = get_bjds([frame_covariates['bjd']])[0]
+	for covariate, value in frame_covariates.items():
+		covariate_dict[covariate].append(value)
+	return covariate_dict
+
+def _get_frame_covariates(covariate_keys, header, retval):
+	"""A calibrated frame's covariates. The 'bjd' entry holds the
+	frame's get_bjd_inputs, so that a whole sequence can be converted
+	to BJDs in one batch by get_bjds."""
+	frame_covariates = {}
+	for covariate in covariate_keys:
+		if covariate == 'bjd':
+			frame_covariates[covariate] = get_bjd_inputs(header)
+		elif covariate == 'bkgs':
+			frame_covariates[covariate] = retval
+		else:
+			frame_covariates[covariate] = header[covariate]
+	return frame_covariates
+
+class FrameCalibrator:
+	"""Calibrates raw science frames against one set of master frames.
+
+	Everything that depends only on the masters -- the combined bad
+	pixel map and its neighbour index, the reciprocal flat, the
+	nonlinearity model and the helium background model -- is computed
+	once when the calibrator is built. Each frame is then calibrated in
+	place in a buffer that is allocated on the first frame and reused
+	for every later one, so the elementwise steps allocate no new
+	full-size frames. Build one calibrator per sequence (or per worker
+	process) and call calibrate_files for each block of frames, or
+	calibrate_file for single frames.
+
+	Parameters
+	------
+	flat, dark : array_like, shape(2048, 2048)
+		the combined flat and dark
+	bp, hp : array_like of bools, shape(2048, 2048)
+		the bad and hot pixel maps
+	sky_stride : int, optional
+		subsampling stride of the sky estimate in 'median' mode (see
+		estimate_sky_level); 1 uses every pixel
+	nonlinearity_model : NonlinearityModel, optional
+		a prebuilt nonlinearity correction; if None and
+		correct_nonlinearity is set, one is built from
+		nonlinearity_array
+	the remaining parameters are as for calibrate_image
+	"""
+	def __init__(self, flat, dark, bp, hp, correct_nonlinearity = False,
+		nonlinearity_array = None, destripe = False,
+		background_mode = None, background_frame = None,
+		multicomponent_frame = None, mask_channels = [],
+		helium_model = None, bad_px_index = None, dtype = np.float64,
+		sky_stride = 17, nonlinearity_model = None):
+		self.dtype = np.dtype(dtype)
+		self.dark = np.asarray(dark, dtype = self.dtype)
+		with np.errstate(divide = 'ignore'):
+			self.inv_flat = np.asarray(1./np.asarray(flat,
+				dtype = np.float64), dtype = self.dtype)
+		self.bad_px_map = np.logical_or(bp, hp)
+		if bad_px_index is None:
+			bad_px_index = make_bad_px_index(self.bad_px_map)
+		self.bad_px_index = bad_px_index
+		self.correct_nonlinearity = correct_nonlinearity
+		if correct_nonlinearity and nonlinearity_model is None:
+			nonlinearity_model = NonlinearityModel(nonlinearity_array,
+				dtype = self.dtype)
+		self.nonlinearity_model = nonlinearity_model
+		self.destripe = destripe
+		self.background_mode = background_mode
+		self.sky_stride = sky_stride
+		if background_frame is not None:
+			background_frame = np.asarray(background_frame,
+				dtype = self.dtype)
+		self.background_frame = background_frame
+		#the static frame's median scales every frame in 'global' mode
+		self.bkg_med = None
+		if background_mode == 'global':
+			self.bkg_med = np.nanmedian(background_frame)
+		if background_mode == 'helium' and helium_model is None:
+			#requires multicomponent frame and reduced background frame
+			helium_model = HeliumBackgroundModel(multicomponent_frame,
+				background_frame)
+		self.helium_model = helium_model
+		self.mask_channels = mask_channels
+		self.frames = None
+		self.scratch = None
+
+	def __getstate__(self):
+		#buffers are per process and are not shipped to workers
+		state = self.__dict__.copy()
+		state['frames'] = None
+		state['scratch'] = None
+		return state
+
+	def get_buffers(self, n_frames, shape):
+		"""Views of the first n_frames frames of the block buffers,
+		which are only reallocated if they are too small."""
+		if self.frames is None or self.frames.shape[1:] != shape or \
+			len(self.frames) < n_frames:
+			self.frames = np.empty((n_frames,) + shape,
+				dtype = self.dtype)
+			self.scratch = np.empty_like(self.frames)
+		return self.frames[:n_frames], self.scratch[:n_frames]
+
+	def calibrate_file(self, im_name):
+		"""Reads and calibrates a raw frame, returning the calibrated
+		frame, the background value(s) and the frame's header."""
+		cleaned, retvals, headers = self.calibrate_files([im_name])
+		return cleaned[0], retvals[0], headers[0]
+
+	def calibrate_files(self, im_names):
+		"""Reads a block of raw frames straight into the block buffer
+		and calibrates them, returning the calibrated frames, the
+		background value(s) of each frame and the frames' headers."""
+		headers = []
+		for k, im_name in enumerate(im_names):
+			with fits.open(im_name) as hdul:
+				if k == 0:
+					frames, scratch = self.get_buffers(
+						len(im_names), hdul[0].data.shape)
+				frames[k] = hdul[0].data
+				headers.append(hdul[0].header)
+		cleaned, retvals = self._calibrate_in_place(frames, scratch,
+			headers)
+		return cleaned, retvals, headers
+
+	def calibrate(self, image, header):
+		"""Calibrates a raw frame.
+
+		Parameters
+		------
+		image : array_like, shape(2048, 2048)
+			the raw frame; it is not modified
+		header : astropy.io.fits.Header
+			the raw frame's header
+
+		Returns
+		-------
+		cleaned : array_like, shape(2048, 2048)
+			the calibrated frame. This is the calibrator's own buffer,
+			overwritten by the next call; copy it to keep it
+		retval : float, array of floats or None
+			the subtracted background level, or the background scale
+			factor(s) in 'global' and 'helium' mode
+		"""
+		cleaned, retvals = self.calibrate_block(np.asarray(image)[None],
+			[header])
+		return cleaned[0], retvals[0]
+
+	def calibrate_block(self, images, headers):
+		"""Calibrates a block of raw frames at once.
+
+		The elementwise steps broadcast the whole block against the
+		master frames, and the per-frame background levels and scales
+		are axis reductions over the block.
+
+		Parameters
+		------
+		images : array_like, shape(K, 2048, 2048)
+			the raw frames; they are not modified
+		headers : list of astropy.io.fits.Header
+			the K raw frames' headers
+
+		Returns
+		-------
+		cleaned : array_like, shape(K, 2048, 2048)
+			the calibrated frames, held in the calibrator's own buffer
+			as for calibrate
+		retvals : list
+			the background value(s) of each frame, as for calibrate
+		"""
+		images = np.asarray(images)
+		frames, scratch = self.get_buffers(len(images), images.shape[1:])
+		frames[...] = images
+		return self._calibrate_in_place(frames, scratch, headers)
+
+	def _calibrate_in_place(self, frames, scratch, headers):
+		if self.correct_nonlinearity:
+			self.nonlinearity_model.apply_block(frames,
+				[header['COADDS'] for header in headers],
+				out = frames, scratch = scratch)
+		frames -= self.dark
+		frames *= self.inv_flat
+		for frame in frames:
+			clean_bad_pix(frame, self.bad_px_map,
+				bad_px_index = self.bad_px_index, out = frame)
+		frames[~np.isfinite(frames)] = 0.
+		retvals = [None]*len(frames)
+		if len(self.mask_channels) > 0:
+			mask_bad_channels(frames, self.mask_channels)
+
+		if self.background_mode == 'median':
+			#simple sigma-clipped median removal
+			meds, _ = estimate_sky_level(frames,
+				stride = self.sky_stride)
+			frames -= meds[:,None,None]
+			retvals = list(meds)
+
+		elif self.background_mode == 'global':
+			#requires reduced background frame
+			scales = np.nanmedian(frames, axis = (1, 2)) / \
+				self.bkg_med
+			frames -= np.multiply(self.background_frame,
+				scales[:,None,None], out = scratch)
+			retvals = list(scales)
+
+		elif self.background_mode == 'helium':
+			for k, frame in enumerate(frames):
+				_, retvals[k] = self.helium_model.subtract(frame,
+					out = frame, scratch = scratch[k])
+
+		if self.destripe:
+			for frame in frames:
+				destripe_image(frame, out = frame)
+
+		return frames, retvals
+
 def mask_bad_channels(cleaned, to_mask):
 	"""channel labeling: bottom left quad, bottom to top = 0-7
 	top right, bottom to top = 8-15
@@ -508,7 +1555,8 @@ def mask_bad_channels(cleaned, to_mask):
 	bottom right, left to right = 24-31
 
 	ordering is basically all horizontal channels bottom to top,
-	then all vertical channels left to right"""
+	then all vertical channels left to right. cleaned may also be a
+	block of frames, shape(K, 2048, 2048)"""
 	for channel in to_mask:
 		c = channel % 16
 		xs = (0, 1024) if c < 8 else (1024, 2048)
@@ -517,86 +1565,244 @@ def mask_bad_channels(cleaned, to_mask):
 			xs = ys
 			ys = (1024, 2048) if c < 8 else (0, 1024)
 
-		cleaned[ys[0]:ys[1], xs[0]:xs[1]] = np.nan
+		cleaned[..., ys[0]:ys[1], xs[0]:xs[1]] = np.nan
 
 	return cleaned
 		
 
 def helium_background_subtraction(cleaned, background_frame,
 	multicomponent_frame):
-	comps = np.unique(multicomponent_frame)
-	img_meds = [sigma_clipped_stats(
-		cleaned[multicomponent_frame == comp],
-		cenfunc = np.nanmedian,
-		stdfunc = np.nanstd)[1] for comp in comps]
-	bkg_meds = [sigma_clipped_stats(
-		background_frame[multicomponent_frame == comp],
-		cenfunc = np.nanmedian,
-		stdfunc = np.nanstd)[1] for comp in comps]
-	scale_factors = np.array(img_meds)/np.array(bkg_meds)
-	new_arr = np.zeros(background_frame.shape)
-	for i, comp in enumerate(comps):
-		working_mask = (multicomponent_frame == comp)
-		new_arr[working_mask] = \
-			background_frame[working_mask]*scale_factors[i]
-
-	return cleaned - new_arr, scale_factors
+	model = HeliumBackgroundModel(multicomponent_frame, background_frame)
+	return model.subtract(cleaned)
+
+class HeliumBackgroundModel:
+	"""Per-component scaling of a background frame for helium
+	observations, where the sky varies radially across the detector.
+
+	The model is built once per night from the multicomponent frame and
+	the reduced background frame. It keeps a CSR-style pixel index per
+	component (the pixels of every component gathered into one padded
+	row) and the sigma-clipped medians of the background frame, so
+	scaling a science frame costs one gather and a few grouped
+	reductions instead of a full-frame mask per component.
+
+	Parameters
+	------
+	multicomponent_frame : array_like, shape(2048, 2048)
+		component label of every pixel
+	background_frame : array_like, shape(2048, 2048)
+		the reduced background frame
+	"""
+	def __init__(self, multicomponent_frame, background_frame):
+		labels = np.ravel(multicomponent_frame)
+		order = np.argsort(labels, kind = 'stable')
+		self.comps, starts, counts = np.unique(labels[order],
+			return_index = True, return_counts = True)
+		self.label_index = np.searchsorted(self.comps,
+			multicomponent_frame)
+		offsets = np.arange(counts.max())
+		self.valid = offsets < counts[:,None]
+		self.gather = order[np.minimum(starts[:,None] + offsets,
+			labels.size - 1)]
+		self.background_frame = background_frame
+		self.bkg_meds = self.component_medians(background_frame)
+
+	def component_medians(self, image):
+		"""Sigma-clipped median of image over each component."""
+		vals = np.where(self.valid, np.ravel(image)[self.gather], np.nan)
+		batched_sigma_clip(vals, axis = 1)
+		return batched_nanmedian(vals, axis = 1)
+
+	def expand(self, scale_factors, out = None):
+		"""Background frame with each component scaled by its
+		entry in scale_factors, written into out if given."""
+		scale_factors = np.asarray(scale_factors,
+			dtype = self.background_frame.dtype)
+		out = np.take(scale_factors, self.label_index, out = out,
+			mode = 'clip')
+		out *= self.background_frame
+		return out
+
+	def subtract(self, cleaned, out = None, scratch = None):
+		"""Scales the background to a science frame component by
+		component and subtracts it, returning the subtracted frame and
+		the scale factors. The frame is written into out if given
+		(which may be cleaned itself), and the scaled background into
+		scratch."""
+		img_meds = self.component_medians(cleaned)
+		scale_factors = img_meds/self.bkg_meds
+		model = self.expand(scale_factors, out = scratch)
+		return np.subtract(cleaned, model, out = out), scale_factors
 	
-def destripe_image(image, sigma = 3, iters=5):
+def destripe_image(image, sigma = 3, iters=5, out = None):
 	"""Destripe the detector by subtracting the median
 	of each row/column from each sector.
 	This will work best after you subtract a background sky image.
 
-	legacy code from WIRC+Pol; updated by Shreyas"""
-
-	quads = []
-	clean_imm = np.array(image)
+	legacy code from WIRC+Pol; updated by Shreyas. The quadrant and
+	column sigma clipping is done in one batched clip over all
+	quadrants and all columns at once. If out is given the destriped
+	frame is written into it, which may be image itself."""
 
+	quads = np.empty((4, 1024, 1024), dtype = _float_dtype(image))
 	for i in range(4):
 		k = 4 - i
 		xr = (0, 1024) if i == 0 or i == 3 else (1024, 2048)
 		yr = (0, 1024) if i == 0 or i == 1 else (1024, 2048)
-		quad = image[xr[0]:xr[1], yr[0]:yr[1]]
-		quad = np.rot90(quad, k = k, axes = (0, 1))
-		quadm = sigma_clip(quad, sigma = 5)
-		quad[quadm.mask] = np.nan
-		quads.append(quad)
-
-	mn_quad = np.nanmedian(quads, axis=0)
-
-	for i in range(1024):
-		to_sub = sigma_clipped_stats(
-			mn_quad[:,i],sigma=sigma,maxiters=iters)[1]
-		clean_imm[:1024,i]  -= to_sub
-		clean_imm[1024:,-i] -= to_sub
-		clean_imm[-i,:1024] -= to_sub
-		clean_imm[i,1024:]  -= to_sub
+		quads[i] = np.rot90(image[xr[0]:xr[1], yr[0]:yr[1]], k = k,
+			axes = (0, 1))
+	batched_sigma_clip(quads, sigma = 5, axis = (1, 2))
+
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		mn_quad = batched_nanmedian(quads, axis = 0)
+		batched_sigma_clip(mn_quad, sigma = sigma, maxiters = iters,
+			axis = 0)
+		to_sub = batched_nanmedian(mn_quad, axis = 0)
+
+	#column i of the median quadrant maps to column i of the lower
+	#left quadrant, column -i of the upper right, row -i of the upper
+	#left and row i of the lower right
+	flipped = -np.arange(1024) % 2048
+	if out is None:
+		out = np.array(image)
+	elif out is not image:
+		out[...] = image
+	clean_imm = out
+	clean_imm[:1024, :1024] -= to_sub
+	clean_imm[1024:, flipped] -= to_sub
+	clean_imm[flipped, :1024] -= to_sub[:, None]
+	clean_imm[:1024, 1024:] -= to_sub[:, None]
 
 	return clean_imm
 
+class NonlinearityModel:
+	"""Quadratic nonlinearity correction of the detector.
+
+	A raw count x per coadd is corrected to the root y of a*y**2 + y = x,
+	with a the per-pixel coefficient. The root is evaluated as
+	y = 2*x/(1 + sqrt(1 + 4*a*x)), which is the usual quadratic formula
+	with the correct root but without its cancellation for small a, and
+	which reduces to y = x for pixels whose coefficient is zero or not
+	finite instead of producing inf or NaN. The 4*a plane is computed
+	once when the model is built, so correcting a frame costs a few
+	in-place passes over it.
+
+	Parameters
+	------
+	nonlinearity_array : array_like, shape(2048, 2048)
+		the per-pixel nonlinearity coefficients
+	dtype : data-type, optional
+		floating point type of the frames the model is applied to
+	"""
+	def __init__(self, nonlinearity_array, dtype = np.float64):
+		self.dtype = np.dtype(dtype)
+		nonlinearity_array = np.asarray(nonlinearity_array,
+			dtype = np.float64)
+		self.shape = nonlinearity_array.shape
+		self.four_a = np.where(np.isfinite(nonlinearity_array),
+			4*nonlinearity_array, 0.).astype(self.dtype)
+
+	def apply(self, image, n_coadd, out = None, scratch = None):
+		"""Corrects a frame taken with n_coadd coadds. The corrected
+		frame is written into out if given (which may be image
+		itself), using scratch, if given, as a work buffer of the
+		frame's shape."""
+		if out is None:
+			out = np.empty(np.shape(image), dtype = self.dtype)
+		return self.apply_block(np.asarray(image)[None], [n_coadd],
+			out = out[None], scratch = None if scratch is None \
+			else scratch[None])[0]
+
+	def apply_block(self, images, n_coadds, out = None, scratch = None):
+		"""Corrects a block of frames at once.
+
+		Parameters
+		------
+		images : array_like, shape(K, 2048, 2048)
+			the raw frames
+		n_coadds : array_like, shape(K)
+			the COADDS header value of each frame
+		out : array_like, shape(K, 2048, 2048), optional
+			array the corrected frames are written into; may be images
+			itself to correct the block in place
+		scratch : array_like, shape(K, 2048, 2048), optional
+			work buffer, allocated if not given
+
+		Returns
+		-------
+		out : array_like, shape(K, 2048, 2048)
+			the corrected frames
+		"""
+		if np.shape(images)[1:] != self.shape:
+			raise ValueError(f"Frames of shape {np.shape(images)[1:]} "
+				f"do not match the nonlinearity coefficients of "
+				f"shape {self.shape}")
+		n_coadds = np.asarray(n_coadds,
+			dtype = self.dtype).reshape(-1, 1, 1)
+		scratch = np.multiply(images, self.four_a, out = scratch,
+			dtype = self.dtype)
+		scratch /= n_coadds
+		scratch += 1
+		np.sqrt(scratch, out = scratch)
+		scratch += 1
+		out = np.multiply(images, 2, out = out, dtype = self.dtype)
+		out /= scratch
+		return out
+
 def nonlinearity_correction(image, header, nonlinearity_arr):
-	assert np.shape(nonlinearity_arr) == np.shape(image)
-	n_coadd = header['COADDS']
-	image_copy = np.array(image, dtype = float) #copy image
-	image_copy /= n_coadd
-	image_copy = (-1 + np.sqrt(1 + 4*nonlinearity_arr*image_copy)) / \
-		(2*nonlinearity_arr) #quadratic formula with correct root
-	return image_copy * n_coadd
-
-def construct_multicomponent_frame(calib_dir, dump_dir, rstepsize = 10):
-	home = (1037, 2120)
-	mcf = np.zeros((2048, 2048))
-	dmax = 2400
-	print("Constructing multicomponent frame...")
-	for i in range(mcf.shape[0]):
-		for j in range(mcf.shape[1]):
-			d = dist(home, (j,i))
-			dist_tag = int(d // rstepsize) + 1
-			mcf[i,j] = dist_tag
-	print("Multicomponent frame constructed!")
-	save_multicomponent_frame(mcf, dump_dir)	
-	return mcf
-	
-def dist(p1, p2):
-	return np.sqrt((p2[1] - p1[1])**2 + (p2[0] - p1[0])**2)
+	"""Corrects a single frame; nonlinearity_arr is either the array of
+	coefficients or a NonlinearityModel. To correct many frames, build
+	the model once and reuse it."""
+	if not isinstance(nonlinearity_arr, NonlinearityModel):
+		nonlinearity_arr = NonlinearityModel(nonlinearity_arr,
+			dtype = _float_dtype(image))
+	return nonlinearity_arr.apply(image, header['COADDS'])
+
+def construct_multicomponent_frame(calib_dir, dump_dir, home = (1037, 2120),
+	rstepsize = 10):
+	"""Labels every pixel of the detector with the index of the ring of
+	width rstepsize, centred on home, in which it sits. The frame is
+	cached in calib_dir under a name made from home and rstepsize, so
+	later calls with the same parameters just load it, and the copy in
+	dump_dir is only written if it is missing or was not copied from
+	this cache.
 
+	Parameters
+	------
+	calib_dir : string
+		path to the directory in which the cached frame is stored
+	dump_dir : string
+		path to the directory into which the frame is saved for
+		photometry
+	home : tuple of ints, optional
+		(x, y) pixel coordinates of the centre of the rings
+	rstepsize : float, optional
+		radial width of each ring in pixels
+
+	Returns
+	-------
+	mcf : array_like, shape(2048, 2048)
+		the multicomponent frame
+	"""
+	cache_name = get_mcf_name(calib_dir, home, rstepsize)
+	try:
+		mcf = np.load(cache_name)
+		print("Loaded saved multicomponent frame...")
+	except FileNotFoundError:
+		print("Constructing multicomponent frame...")
+		ys, xs = np.indices((2048, 2048))
+		d = np.sqrt((ys - home[1])**2 + (xs - home[0])**2)
+		mcf = (d // rstepsize + 1).astype(float)
+		save_npy(mcf, cache_name)
+		print("Multicomponent frame constructed!")
+	#the dump_dir copy carries the mtime of the cache it was copied
+	#from, and is only rewritten if it is missing or was made from a
+	#different (or since rebuilt) cache
+	cache_mtime = os.stat(cache_name).st_mtime_ns
+	dump_name = get_mcf_dump_name(dump_dir)
+	if not os.path.exists(dump_name) or \
+		os.stat(dump_name).st_mtime_ns != cache_mtime:
+		save_multicomponent_frame(mcf, dump_dir)
+		os.utime(dump_name, ns = (cache_mtime, cache_mtime))
+	return mcf
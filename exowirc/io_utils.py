@@ -1,44 +1,169 @@
 from pathlib import Path
+from collections import OrderedDict
 from astropy.io import fits
+import os
+import json
+import hashlib
 import numpy as np
 import pickle
 
 #calibration io
 
-def save_image(data, imname):
+def save_image(data, imname, dtype = None):
+	if dtype is not None:
+		data = np.asarray(data, dtype = dtype)
 	hdu = fits.PrimaryHDU(data)
 	hdu.writeto(imname, overwrite = True)
 	return None
 
-def load_calib_img(calib_dir, img_number, style = 'wirc', img_type = ''):
+def load_calib_img(calib_dir, img_number, style = 'wirc', img_type = '',
+	dtype = None):
 	fname = get_img_name(calib_dir, img_number, style = style,
 		img_type = img_type)
-	with fits.open(fname) as hdul:
-                data = hdul[0].data
+	return open_frame(fname, dtype = dtype)
+
+def open_frame(fname, dtype = None, ext = 0, return_header = False):
+	"""Opens a frame read-only without reading its pixels. Uncompressed
+	floating point frames without BSCALE/BZERO scaling are memory-mapped
+	straight from the file, so only the pages that are actually indexed
+	are ever read; any other frame (integer or scaled data, or a dtype
+	that differs from the stored one) falls back to a read-only
+	converted copy.
+
+	Parameters
+	------
+	fname : string
+		Path to the FITS file
+	dtype : data-type, optional
+		Floating point type of the returned data. A memory-map is only
+		returned if this matches the type stored in the file; the byte
+		order may be the file's big-endian one.
+	ext : int, optional
+		Index of the HDU holding the frame
+	return_header : boolean, optional
+		If True, the HDU header is returned as well
+
+	Returns
+	-------
+	data : array_like
+		read-only frame data
+	header : astropy.io.fits.Header
+		header of the HDU, only returned if return_header is True
+	"""
+	with fits.open(fname, memmap = False, lazy_load_hdus = True) as hdul:
+		header = hdul[ext].header
+		info = hdul.fileinfo(ext)
+		bitpix = header['BITPIX']
+		shape = tuple(header[f'NAXIS{k}'] for k in \
+			range(header['NAXIS'], 0, -1))
+		file_dtype = np.dtype(f'>f{abs(bitpix)//8}')
+		mappable = bitpix in (-32, -64) and len(shape) > 0 and \
+			header.get('BSCALE', 1) == 1 and \
+			header.get('BZERO', 0) == 0 and \
+			info['file'].compression is None and \
+			(dtype is None or np.dtype(dtype) == \
+			file_dtype.newbyteorder('='))
+		if mappable:
+			data = np.memmap(fname, dtype = file_dtype, mode = 'r',
+				offset = info['datLoc'], shape = shape)
+		else:
+			data = np.array(hdul[ext].data, dtype = dtype)
+			data.flags.writeable = False
+	if return_header:
+		return data, header
 	return data
 
+def save_npy(arr, fname):
+	"""Saves an array with np.save via a temporary file, so that an
+	interrupted write never leaves a truncated file under fname."""
+	temp_name = fname + '.tmp'
+	with open(temp_name, 'wb') as f:
+		np.save(f, arr)
+	os.replace(temp_name, fname)
+	return fname
+
+def get_mcf_dump_name(dump_dir):
+	return dump_dir + 'multicomponent_frame.npy'
+
 def save_multicomponent_frame(mcf, dump_dir):
-	frame = pickle.dump(mcf, open(
-		dump_dir + 'multicomponent_frame.p', 'wb'))
-	return frame
+	return save_npy(mcf, get_mcf_dump_name(dump_dir))
 
 def load_multicomponent_frame(dump_dir):
-	mcf = pickle.load(open(dump_dir + 'multicomponent_frame.p', 'rb'))
-	return mcf
-
-def load_calib_files(flat, dark, bp, hp, nonlinearity_fname = None):
-	with fits.open(flat) as hdul:
-		flat = hdul[0].data
-	with fits.open(dark) as hdul:
-		dark = hdul[0].data
-	with fits.open(bp) as hdul:
-		bp = np.array(hdul[0].data, dtype = 'bool')
-	with fits.open(hp) as hdul:
-		hp = np.array(hdul[0].data, dtype = 'bool')
+	try:
+		return np.load(get_mcf_dump_name(dump_dir))
+	except FileNotFoundError:
+		#frames saved by older versions were pickled
+		return pickle.load(open(dump_dir + 'multicomponent_frame.p',
+			'rb'))
+
+#master calibration frame cache
+
+_calib_cache = OrderedDict()
+_calib_cache_max_bytes = 2*2**30
+
+def set_calib_cache_size(max_bytes):
+	"""Sets the byte-size limit of the master calibration frame cache,
+	evicting the least recently used frames if necessary."""
+	global _calib_cache_max_bytes
+	_calib_cache_max_bytes = max_bytes
+	_trim_calib_cache()
+	return None
+
+def clear_calib_cache():
+	_calib_cache.clear()
+	return None
+
+def _trim_calib_cache():
+	total = sum(entry[-1].nbytes for entry in _calib_cache.values())
+	while total > _calib_cache_max_bytes and len(_calib_cache) > 0:
+		_, (_, _, data) = _calib_cache.popitem(last = False)
+		total -= data.nbytes
+
+def load_master_frame(fname, ext = 0, dtype = None):
+	"""Reads the data of a master calibration frame through a
+	process-wide LRU cache, so each master is decoded once per run.
+
+	Entries are keyed on the path, extension and dtype and are only
+	reused while the file's mtime and size are unchanged. The cache is
+	bounded in bytes (see set_calib_cache_size). The returned arrays
+	are shared between callers and are therefore read-only.
+
+	Parameters
+	------
+	fname : string
+		path to the FITS file
+	ext : int, optional
+		the HDU holding the frame
+	dtype : data-type or None, optional
+		if not None, the frame is converted to this type
+
+	Returns
+	-------
+	data : array_like
+		read-only frame data
+	"""
+	stat = os.stat(fname)
+	key = (os.path.abspath(fname), ext,
+		None if dtype is None else np.dtype(dtype).str)
+	entry = _calib_cache.pop(key, None)
+	if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+		data = np.array(open_frame(fname, ext = ext), dtype = dtype)
+		data.flags.writeable = False
+		entry = (stat.st_mtime_ns, stat.st_size, data)
+	_calib_cache[key] = entry
+	_trim_calib_cache()
+	return entry[-1]
+
+def load_calib_files(flat, dark, bp, hp, nonlinearity_fname = None,
+	dtype = None):
+	flat = load_master_frame(flat, dtype = dtype)
+	dark = load_master_frame(dark, dtype = dtype)
+	bp = load_master_frame(bp, dtype = 'bool')
+	hp = load_master_frame(hp, dtype = 'bool')
 
 	if nonlinearity_fname is not None:
-		with fits.open(nonlinearity_fname) as hdu:
-			nonlinearity_array = hdu[1].data
+		nonlinearity_array = load_master_frame(nonlinearity_fname,
+			ext = 1, dtype = dtype)
 		correct_nonlinearity = True
 	else:
 		nonlinearity_array = None
@@ -46,6 +171,175 @@ def load_calib_files(flat, dark, bp, hp, nonlinearity_fname = None):
 
 	return flat, dark, bp, hp, nonlinearity_array, correct_nonlinearity
 
+#calibration product manifest
+
+def get_manifest_name(calib_dir):
+	return calib_dir + 'calib_manifest.json'
+
+def load_manifest(calib_dir):
+	"""Loads the manifest recording the inputs each saved calibration
+	product in calib_dir was made from. Returns an empty manifest if
+	there is none yet."""
+	try:
+		with open(get_manifest_name(calib_dir)) as f:
+			return json.load(f)
+	except (FileNotFoundError, ValueError):
+		return {}
+
+def save_manifest(calib_dir, manifest):
+	fname = get_manifest_name(calib_dir)
+	with open(fname + '.tmp', 'w') as f:
+		json.dump(manifest, f, indent = 1, sort_keys = True)
+	os.replace(fname + '.tmp', fname)
+	return fname
+
+def get_product_digest(input_files, params):
+	"""Hashes the list of input files, their sizes and modification
+	times, and the parameters used to make a calibration product."""
+	inputs = []
+	for fname in input_files:
+		stat = os.stat(fname)
+		inputs.append([os.path.abspath(fname), stat.st_size,
+			stat.st_mtime_ns])
+	record = json.dumps({'inputs': inputs, 'params': params},
+		sort_keys = True, default = str)
+	return hashlib.sha256(record.encode()).hexdigest()
+
+def check_product(manifest, products, digest):
+	"""True if every product file exists unmodified and was recorded
+	in the manifest with the given input digest."""
+	for fname in products:
+		entry = manifest.get(os.path.basename(fname))
+		if entry is None or entry['digest'] != digest:
+			return False
+		try:
+			stat = os.stat(fname)
+		except FileNotFoundError:
+			return False
+		if [stat.st_size, stat.st_mtime_ns] != \
+			[entry['size'], entry['mtime_ns']]:
+			return False
+	return True
+
+def record_product(manifest, products, digest):
+	for fname in products:
+		stat = os.stat(fname)
+		manifest[os.path.basename(fname)] = {'digest': digest,
+			'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+	return manifest
+
+#calibration journal
+
+def get_journal_name(dump_dir):
+	return dump_dir + 'calib_journal.jsonl'
+
+def get_file_checksum(fname):
+	sha = hashlib.sha256()
+	with open(fname, 'rb') as f:
+		for chunk in iter(lambda: f.read(2**20), b''):
+			sha.update(chunk)
+	return sha.hexdigest()
+
+def append_journal(dump_dir, entries):
+	"""Appends entries to the calibration journal in dump_dir, one JSON
+	line each. The journal is flushed and synced to disk before
+	returning, so a crash loses at most a partly written last line,
+	which load_journal skips."""
+	fname = get_journal_name(dump_dir)
+	with open(fname, 'a') as f:
+		if f.tell() > 0 and not _ends_with_newline(fname):
+			#terminate a line cut short by an interrupted run
+			f.write('\n')
+		for entry in entries:
+			f.write(json.dumps(_encode_journal_value(entry)) + '\n')
+		f.flush()
+		os.fsync(f.fileno())
+	return None
+
+def _ends_with_newline(fname):
+	with open(fname, 'rb') as f:
+		f.seek(-1, os.SEEK_END)
+		return f.read(1) == b'\n'
+
+def load_journal(dump_dir, run_key):
+	"""Reads the calibration journal in dump_dir, returning the latest
+	entry of each frame calibrated in a run with the given key, keyed
+	on frame number. The journal is compacted on disk to the latest
+	entry of each calibrated output, so it does not grow with every
+	rerun."""
+	journal = {}
+	fname = get_journal_name(dump_dir)
+	try:
+		f = open(fname)
+	except FileNotFoundError:
+		return journal
+	latest = {}
+	n_lines = 0
+	with f:
+		for line in f:
+			n_lines += 1
+			try:
+				entry = json.loads(line,
+					object_hook = _decode_journal_value)
+			except ValueError:
+				#a line cut short by an interrupted run
+				continue
+			#a later entry for the same output supersedes earlier ones
+			latest.pop(entry['path'], None)
+			latest[entry['path']] = line.rstrip('\n')
+			if entry.get('run') == run_key:
+				journal[entry['frame']] = entry
+	if len(latest) < n_lines:
+		_rewrite_journal(fname, latest.values())
+	return journal
+
+def _rewrite_journal(fname, lines):
+	#written aside and swapped in so a crash leaves either journal whole
+	tmpname = fname + '.tmp'
+	with open(tmpname, 'w') as f:
+		for line in lines:
+			f.write(line + '\n')
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmpname, fname)
+	return None
+
+def check_journal_entry(entry):
+	"""True if the calibrated frame a journal entry points to still
+	exists unmodified, judged by its file stats and checksum."""
+	try:
+		stat = os.stat(entry['path'])
+	except FileNotFoundError:
+		return False
+	if [stat.st_size, stat.st_mtime_ns] != \
+		[entry['size'], entry['mtime_ns']]:
+		return False
+	return get_file_checksum(entry['path']) == entry['sha256']
+
+def _encode_journal_value(val):
+	#numpy values and tuples are tagged so that covariates read back
+	#from the journal have the same types as freshly computed ones
+	if isinstance(val, dict):
+		return {key: _encode_journal_value(v) for key, v in val.items()}
+	if isinstance(val, list):
+		return [_encode_journal_value(v) for v in val]
+	if isinstance(val, tuple):
+		return {'__tuple__': [_encode_journal_value(v) for v in val]}
+	if isinstance(val, np.ndarray):
+		return {'__array__': val.tolist(), 'dtype': val.dtype.str}
+	if isinstance(val, np.generic):
+		return {'__scalar__': val.item(), 'dtype': val.dtype.str}
+	return val
+
+def _decode_journal_value(obj):
+	if '__tuple__' in obj:
+		return tuple(obj['__tuple__'])
+	if '__array__' in obj:
+		return np.array(obj['__array__'], dtype = obj['dtype'])
+	if '__scalar__' in obj:
+		return np.dtype(obj['dtype']).type(obj['__scalar__'])
+	return obj
+
 def get_science_img_list(science_ranges):
 	to_extract = np.array([])
 	for seq in science_ranges:
@@ -100,6 +394,10 @@ def get_img_name(direc, number, style = 'wirc', img_type = ''):
 		img_type = '_' + img_type
 	return direc + style + '0'*num_zeros + num + img_type + '.fits'
 
+def get_mcf_name(direc, home, rstepsize):
+	return f'{direc}multicomponent_frame_{home[0]}_{home[1]}_' + \
+		f'{rstepsize}.npy'
+
 def get_bkg_file_name(direc, bkg_num, style = 'wirc'):
 	return get_img_name(direc, bkg_num, style = style,
 		img_type = 'calibrated_background')
@@ -0,0 +1,27 @@
+import numpy as np
+
+from exowirc.photo_utils import centroid_sources, estimate_widths
+
+def make_cutouts(n_sources, size = 40, sigma = 3., seed = 0):
+	rng = np.random.default_rng(seed)
+	y, x = np.mgrid[:size, :size]
+	star = 1000*np.exp(-((x - size/2)**2 + (y - size/2)**2)/(2*sigma**2))
+	return star + rng.normal(0., 1., (n_sources, size, size))
+
+def test_gauss2d_widths_survive_bad_sources():
+	#a centroid outside its cutout leaves no pixels to fit; it must not
+	#break the batched solve for the other sources
+	cutouts = make_cutouts(3)
+	widths = estimate_widths(cutouts, [20., 60., 20.], [20., 20., -40.],
+		10., method = 'gauss2d')
+	assert np.isclose(widths[0], 3., rtol = 1.e-2)
+	assert np.all(np.isnan(widths[1:]))
+
+def test_gauss2d_widths_of_noise_and_blank_cutouts():
+	rng = np.random.default_rng(2)
+	cutouts = np.concatenate([rng.normal(0., 1., (4, 40, 40)),
+		np.zeros((1, 40, 40)), make_cutouts(1)])
+	xc, yc = centroid_sources(cutouts, [20.]*6, [20.]*6, 10.)
+	widths = estimate_widths(cutouts, xc, yc, 10., method = 'gauss2d')
+	assert np.isclose(widths[-1], 3., rtol = 1.e-2)
+	assert np.isnan(widths[4])